@@ -1,39 +1,120 @@
+import os.path
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
+
+import ijson
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from packaging.utils import canonicalize_name
 from packaging.version import InvalidVersion, Version
-from pypi_simple import NoSuchProjectError, PyPISimple, UnsupportedContentTypeError, UnsupportedRepoVersionError
+from pypi_simple import (
+    ACCEPT_JSON_PREFERRED,
+    NoSuchProjectError,
+    PyPISimple,
+    UnsupportedContentTypeError,
+    UnsupportedRepoVersionError,
+)
 from rich import box, progress
 from rich.console import Console
 from rich.prompt import Confirm
 from rich.table import Table
 
+from . import __version__
 from .options import Options
-from .reqfile import Line, LineType, ReqFile, UpdateStatus
+from .reqfile import ENCODING, ENCODING_ERRORS, Line, LineType, ReqFile, UpdateStatus, parse_files
 
 
 TIMEOUT = 5
+CACHE_EXPIRE = 3600
+WORKERS = 16
+
+# Where to find a package's URL in JSON API responses, in order of preference
+PROJECT_URL_KEYS = ('Changelog', 'Changes')
+INFO_URL_KEYS = ('docs_url', 'project_url', 'home_page', 'package_url')
 
 
 class CheckFailed(Exception):
     pass
 
 
+def _stable_versions(versions: Iterable[str | None]) -> Iterator[tuple[Version, str]]:
+    for ver in versions:
+        if ver is None:
+            continue
+        try:
+            ver_obj = Version(ver)
+        except InvalidVersion:
+            continue
+
+        # Post-releases are kept, as the JSON API also counts them as the latest version
+        if not (ver_obj.is_devrelease or ver_obj.is_prerelease):
+            yield ver_obj, ver
+
+
 class Disrepair:
-    requirements_files: list[ReqFile] = []
-    updates: list[Line] = []
-    unpinned: list[Line] = []
-    up2date: list[Line] = []
-    errors: list[Line] = []
-    unsupported: list[Line] = []
+    __slots__ = (
+        "console",
+        "opt",
+        "session",
+        "simple_client",
+        "requirements_files",
+        "updates",
+        "unpinned",
+        "up2date",
+        "errors",
+        "unsupported",
+    )
 
     def __init__(self, opt: Options):
+        self.requirements_files: list[ReqFile] = []
+        self.updates: list[Line] = []
+        self.unpinned: list[Line] = []
+        self.up2date: list[Line] = []
+        self.errors: list[Line] = []
+        self.unsupported: list[Line] = []
+
         self.console = Console()
         opt.json_repo = opt.json_repo.rstrip('/')
         opt.simple_repo = opt.simple_repo.rstrip('/')
         self.opt = opt
 
+        if opt.no_cache:
+            self.session = requests.Session()
+        else:
+            # Cache-Control headers sent by the repository take precedence over CACHE_EXPIRE
+            self.session = requests_cache.CachedSession(
+                'disrepair',
+                backend='sqlite',
+                use_cache_dir=True,
+                expire_after=CACHE_EXPIRE,
+                cache_control=True,
+            )
+        self.session.headers['User-Agent'] = f'disrepair/{__version__}'
+        # Each worker has at most one request in flight, so WORKERS connections per host is
+        # enough; blocking on the pool keeps every request on an already open connection.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=WORKERS, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.simple_client = PyPISimple(
+            endpoint=self.opt.simple_repo,
+            session=self.session,
+            accept=ACCEPT_JSON_PREFERRED,
+        )
+
+    def __enter__(self) -> 'Disrepair':
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
     def get_pypi_version(self, name: str) -> tuple[str | None, str | None]:
         try:
-            r = requests.get(f"{self.opt.json_repo}/{name}/json", timeout=TIMEOUT)
+            r = self.session.get(f"{self.opt.json_repo}/{name}/json", timeout=TIMEOUT)
         except requests.Timeout:
             raise CheckFailed("Timeout exceeded when connecting to PyPI")
         except requests.ConnectionError:
@@ -45,123 +126,143 @@ class Disrepair:
         if not r.ok:
             raise CheckFailed(f"PyPI return code {r.status_code}")
 
-        data = r.json()
+        # Only the 'info' object is needed. It comes before the (much larger) release
+        # history, so stop parsing as soon as it has been read.
         try:
-            ver = data["info"]["version"]
-        except KeyError:
+            info = next(ijson.items(r.content, 'info'), None)
+        except ijson.JSONError:
             raise CheckFailed("PyPI returned a malformed response")
 
-        if 'info' in data:
-            if 'project_urls' in data['info']:
-                if data['info']['project_urls']:
-                    if 'Changelog' in data['info']['project_urls']:
-                        if data['info']['project_urls']['Changelog']:
-                            return ver, data['info']['project_urls']['Changelog']
-
-                    if 'Changes' in data['info']['project_urls']:
-                        if data['info']['project_urls']['Changes']:
-                            return ver, data['info']['project_urls']['Changes']
-
-            if 'docs_url' in data['info']:
-                if data['info']['docs_url']:
-                    return ver, data['info']['docs_url']
+        if not isinstance(info, dict) or "version" not in info:
+            raise CheckFailed("PyPI returned a malformed response")
+        ver = info["version"]
 
-            if 'project_url' in data['info']:
-                if data['info']['project_url']:
-                    return ver, data['info']['project_url']
+        project_urls = info.get('project_urls') or {}
+        if not isinstance(project_urls, dict):
+            raise CheckFailed("PyPI returned a malformed response")
 
-            if 'home_page' in data['info']:
-                if data['info']['home_page']:
-                    return ver, data['info']['home_page']
+        for key in PROJECT_URL_KEYS:
+            if url := project_urls.get(key):
+                return ver, url
 
-            if 'package_url' in data['info']:
-                if data['info']['package_url']:
-                    return ver, data['info']['package_url']
+        for key in INFO_URL_KEYS:
+            if url := info.get(key):
+                return ver, url
 
         return ver, None
 
     def get_pypi_simple_version(self, name: str) -> tuple[str | None, str | None]:
-        with PyPISimple(endpoint=self.opt.simple_repo) as client:
-            try:
-                page = client.get_project_page(name, timeout=TIMEOUT)
-            except requests.RequestException:
-                raise CheckFailed("Connection error")
-            except UnsupportedRepoVersionError:
-                raise CheckFailed("Unsupported repo version")
-            except UnsupportedContentTypeError:
-                raise CheckFailed("Unsupported content type")
-            except NoSuchProjectError:
-                raise CheckFailed("Package not found")
-            except Exception as exc:
-                raise CheckFailed(f"Unexpected error: {exc}")
-
-            if page is None:
-                raise CheckFailed("Package not found")
-
-            if not page.packages:
-                raise CheckFailed("Package not found")
-
-            # There is no guarantee that versions are listed in order.
-            # We must thus check every version and pick the latest stable version.
-
-            chosen_version = None
-            for pkg in page.packages:
-                if pkg.version is None:
-                    continue
-                try:
-                    pkg_version_obj = Version(pkg.version)
-                except InvalidVersion:
-                    continue
-
-                if (
-                    not pkg_version_obj.is_devrelease
-                    and not pkg_version_obj.is_postrelease
-                    and not pkg_version_obj.is_prerelease
-                ):
-
-                    if chosen_version is None:
-                        chosen_version = pkg.version
-                        chosen_version_obj = pkg_version_obj
-                    else:
-                        if pkg_version_obj > chosen_version_obj:
-                            chosen_version = pkg.version
-                            chosen_version_obj = pkg_version_obj
+        try:
+            page = self.simple_client.get_project_page(name, timeout=TIMEOUT)
+        except requests.RequestException:
+            raise CheckFailed("Connection error")
+        except UnsupportedRepoVersionError:
+            raise CheckFailed("Unsupported repo version")
+        except UnsupportedContentTypeError:
+            raise CheckFailed("Unsupported content type")
+        except NoSuchProjectError:
+            raise CheckFailed("Package not found")
+        except Exception as exc:
+            raise CheckFailed(f"Unexpected error: {exc}")
+
+        if page is None:
+            raise CheckFailed("Package not found")
+
+        if not page.packages:
+            raise CheckFailed("Package not found")
+
+        # There is no guarantee that versions are listed in order.
+        # We must thus check every version and pick the latest stable version.
+        # Each version usually has several files, so only parse each one once. Yanked
+        # files are skipped, as the JSON API never reports a yanked version as the latest.
+        versions = dict.fromkeys(pkg.version for pkg in page.packages if not pkg.is_yanked)
+        chosen = max(_stable_versions(versions), key=itemgetter(0), default=None)
 
-            if chosen_version is None:
-                raise CheckFailed("Could not find a suitable version")
+        if chosen is None:
+            raise CheckFailed("Could not find a suitable version")
 
-            # The simple api offers no url :(
-            return chosen_version, None
+        # The simple api offers no url :(
+        return chosen[1], None
 
     def get_version(self, name: str) -> tuple[str | None, str | None]:
-        latest = None
-        if not self.opt.simple_only:
+        lookups: tuple[Callable[[str], tuple[str | None, str | None]], ...]
+        if self.opt.json_only:
+            lookups = (self.get_pypi_version,)
+        elif self.opt.simple_only:
+            lookups = (self.get_pypi_simple_version,)
+        elif self.opt.info:
+            lookups = (self.get_pypi_version, self.get_pypi_simple_version)
+        else:
+            # The Simple API (PEP 691 JSON) response is far smaller than the JSON API's,
+            # but it has no URLs, so it is only preferred when they won't be shown.
+            lookups = (self.get_pypi_simple_version, self.get_pypi_version)
+
+        latest = url = None
+        for lookup in lookups:
             try:
-                latest, url = self.get_pypi_version(name)
+                latest, url = lookup(name)
             except CheckFailed:
-                if self.opt.json_only:
+                if lookup is lookups[-1]:
                     raise
-
-        if not self.opt.json_only:
-            if latest is None:
-                latest, url = self.get_pypi_simple_version(name)
+            else:
+                if latest is not None:
+                    break
 
         if latest is None:
             raise CheckFailed("Package not found")
 
         return latest, url
 
+    def get_url(self, line: Line) -> str | None:
+        # Versions may have come from the Simple API, which has no URLs; only go
+        # to the JSON API for the packages where a URL will actually be shown.
+        if line.url is None and line.pkgname and not self.opt.simple_only:
+            try:
+                _, line.url = self.get_pypi_version(line.pkgname)
+            except CheckFailed:
+                pass
+        return line.url
+
     def _parse_file(self, filename: str) -> None:
-        rf = ReqFile(filename)
+        # Parse the include tree a level at a time, so that all the files included
+        # by one level can be parsed in parallel.
+        parsed: dict[str, ReqFile] = {}
+        level = [filename]
+        while level:
+            todo: dict[str, str] = {}
+            for path in level:
+                realpath = os.path.realpath(path)
+                if realpath not in parsed:
+                    todo.setdefault(realpath, path)
+
+            found = parse_files(list(todo.values()))
+            parsed.update(zip(todo, found))
+            level = [fp for rf in found for fp in rf.other_files]
+
+        self._add_file(filename, parsed, set())
+
+    def _add_file(self, filename: str, parsed: dict[str, ReqFile], seen: set[str]) -> None:
+        # Files may include each other, or share includes; only add each one once
+        realpath = os.path.realpath(filename)
+        if realpath in seen:
+            return
+        seen.add(realpath)
+
+        rf = parsed[realpath]
         self.requirements_files.append(rf)
 
         for fp in rf.other_files:
-            self._parse_file(fp)
+            self._add_file(fp, parsed, seen)
 
     def _fetch_metadata(self) -> None:
-        lines: list[Line] = []
+        # A package listed in several files (or twice in one) is only looked up once,
+        # under the name it was first listed as
+        groups: dict[str, tuple[str, list[Line]]] = {}
         for reqfile in self.requirements_files:
-            lines.extend(reqfile.lines)
+            for line in reqfile.lines:
+                pkgname = line.pkgname
+                if line.ltype == LineType.requirement and pkgname:
+                    groups.setdefault(canonicalize_name(pkgname), (pkgname, []))[1].append(line)
 
         with progress.Progress(
             progress.SpinnerColumn(),
@@ -172,45 +273,65 @@ class Disrepair:
             console=self.console,
             transient=True,
         ) as status:
-            task = status.add_task("[bold]Checking", total=len(lines))
-            for line in lines:
-                if line.ltype == LineType.requirement:
-                    if line.pkgname:
-                        try:
-                            line.latest, line.url = self.get_version(line.pkgname)
-                        except CheckFailed as ex:
+            task = status.add_task("[bold]Checking", total=sum(len(group) for _, group in groups.values()))
+
+            with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+                futures = {executor.submit(self.get_version, pkgname): group for pkgname, group in groups.values()}
+
+                for future in as_completed(futures):
+                    group = futures[future]
+                    try:
+                        latest, url = future.result()
+                    except CheckFailed as ex:
+                        for line in group:
                             line.error = str(ex)
-                            self.errors.append(line)
-                        else:
-                            if line.spec is None:
-                                line.status = UpdateStatus.unpinned
-                                self.unpinned.append(line)
-                            else:
-                                if line.latest:
-                                    ver_latest = Version(line.latest)
-                                    ver_spec = Version(line.spec)
-                                    if ver_latest > ver_spec:
-                                        line.status = UpdateStatus.behind
-                                        self.updates.append(line)
-
-                                    elif ver_latest == ver_spec:
-                                        line.status = UpdateStatus.ok
-                                        self.up2date.append(line)
-
-                                    elif ver_latest < ver_spec:
-                                        line.error = (
-                                            "Specified version "
-                                            f"({line.spec}) is greater than the "
-                                            f"latest published version ({line.latest})"
-                                        )
-                                        self.errors.append(line)
-
-                elif line.ltype == LineType.error:
+                    else:
+                        for line in group:
+                            line.latest, line.url = latest, url
+                    status.update(task, advance=len(group))
+
+        # Results arrive in completion order; sort them into the report lists
+        # in file order so the output is stable between runs.
+        for reqfile in self.requirements_files:
+            for line in reqfile.lines:
+                self._classify(line)
+
+    def _classify(self, line: Line) -> None:
+        if line.ltype == LineType.requirement:
+            if line.pkgname:
+                if line.error:
                     self.errors.append(line)
-                elif line.ltype == LineType.unsupported:
-                    self.unsupported.append(line)
+                elif line.spec_ver is None:
+                    line.status = UpdateStatus.unpinned
+                    self.unpinned.append(line)
+                elif line.latest == line.spec:
+                    # Identical strings are always equal versions; skip parsing the common case
+                    line.status = UpdateStatus.ok
+                    self.up2date.append(line)
+                else:
+                    if line.latest:
+                        ver_latest = Version(line.latest)
+                        ver_spec = line.spec_ver
+                        if ver_latest > ver_spec:
+                            line.status = UpdateStatus.behind
+                            self.updates.append(line)
+
+                        elif ver_latest == ver_spec:
+                            line.status = UpdateStatus.ok
+                            self.up2date.append(line)
+
+                        elif ver_latest < ver_spec:
+                            line.error = (
+                                "Specified version "
+                                f"({line.spec}) is greater than the "
+                                f"latest published version ({line.latest})"
+                            )
+                            self.errors.append(line)
 
-                status.update(task, advance=1)
+        elif line.ltype == LineType.error:
+            self.errors.append(line)
+        elif line.ltype == LineType.unsupported:
+            self.unsupported.append(line)
 
     def _print_reqs(self) -> None:
         table = Table(box=box.SIMPLE_HEAVY)
@@ -299,9 +420,9 @@ class Disrepair:
                                 self.console.print(f'[bold]{line.pkgname}[/bold] {reqfile.filename}')
                             else:
                                 self.console.print(f'[bold]{line.pkgname}')
-                            if self.opt.info:
-                                if line.url is not None:
-                                    self.console.print(line.url)
+                            url = self.get_url(line)
+                            if url is not None:
+                                self.console.print(url)
                             self.console.print(f'Current: {line.spec or "Unpinned"}')
                             self.console.print(f'Latest: {line.latest}')
                             do_update = Confirm.ask("Do you want to update?", default=True)
@@ -312,7 +433,7 @@ class Disrepair:
 
         for reqfile in self.requirements_files:
             if num_updated:
-                with open(reqfile.filepath, mode='w') as fp:
+                with open(reqfile.filepath, mode='w', encoding=ENCODING, errors=ENCODING_ERRORS) as fp:
                     for line in reqfile.lines:
                         if line.line is not None:
                             fp.write(line.line)
@@ -12,6 +12,7 @@ shared_params = [
     click.Option(['--simple-repo', '-s'], default=SIMPLE_REPO, help='Repository URL for the Simple API'),
     click.Option(['--json-only', '-J'], is_flag=True, help='Only use the JSON API to lookup versions'),
     click.Option(['--simple-only', '-S'], is_flag=True, help='Only use the Simple API to lookup versions'),
+    click.Option(['--no-cache', '-n'], is_flag=True, help='Do not use or update the local HTTP cache'),
 ]
 
 
@@ -34,7 +35,8 @@ def check(ctx: click.Context, filename: str, **kwargs: Any) -> None:
     if opts.simple_only and opts.json_only:
         ctx.fail("--simple-only and --json-only cannot both be set")
 
-    Disrepair(opts).cmd_check(filename)
+    with Disrepair(opts) as disrepair:
+        disrepair.cmd_check(filename)
 
 
 @cli.command(params=shared_params.copy())
@@ -47,11 +49,11 @@ def update(ctx: click.Context, filename: str, **kwargs: Any) -> None:
     Update dependencies in a requirements file to the latest version
     '''
     opts = Options(**kwargs)
-    opts.info = True
     if opts.simple_only and opts.json_only:
         ctx.fail("--simple-only and --json-only cannot both be set")
 
-    Disrepair(opts).cmd_update(filename)
+    with Disrepair(opts) as disrepair:
+        disrepair.cmd_update(filename)
 
 
 @cli.command()
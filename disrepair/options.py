@@ -4,12 +4,13 @@ JSON_REPO = 'https://pypi.org/pypi'
 SIMPLE_REPO = "https://pypi.org/simple"
 
 
-@dataclass
+@dataclass(slots=True)
 class Options:
     json_only: bool = False
     json_repo: str = JSON_REPO
     simple_only: bool = False
     simple_repo: str = SIMPLE_REPO
+    no_cache: bool = False
     info: bool = False
     verbose: bool = False
     unpinned: bool = False
@@ -1,27 +1,82 @@
 #!/usr/bin/env python
 
+import io
+import mmap
 import os.path
+import re
+import stat
+import sys
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from enum import Enum
+from enum import IntEnum
+from typing import Final, cast
 
+from packaging.version import InvalidVersion, Version
 from requirements.requirement import Requirement
 
 
-class LineType(Enum):
-    requirement = "requirement"
-    error = "error"
-    unsupported = "unsupported"
-    other = "other"
+# A bare package name, optionally pinned with == or >= and followed by a comment.
+# Anything else (extras, markers, URLs, multiple specs) goes through Requirement.parse.
+_SIMPLE_REQ_RE: Final = re.compile(
+    r"^\s*(?P<name>[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)"
+    r"\s*(?:(?:==|>=)\s*(?P<spec>[A-Za-z0-9][A-Za-z0-9.+!_-]*))?"
+    r"(?:\s+#.*)?\s*$"
+)
 
+# Other requirements files. The separator is required so that e.g. '-requirement'
+# is not mistaken for '-r'.
+_REQ_INCLUDE: Final = ("-r ", "-r\t", "--requirement ", "--requirement=", "--requirement\t")
+_SUPPORTED_OPS: Final = frozenset(("==", ">="))
 
-class UpdateStatus(Enum):
-    ok = 'ok'
-    behind = 'behind'
-    unpinned = 'unpinned'
-    unknown = 'unknown'
+# Requirements files are read and written back with these. Undecodable bytes are
+# carried through as surrogates so that they are rewritten unchanged.
+ENCODING: Final = "utf-8"
+ENCODING_ERRORS: Final = "surrogateescape"
 
+# Files at least this large are memory-mapped rather than read
+MMAP_MIN_SIZE: Final = 64 * 1024
 
-@dataclass
+# Below this many files, starting worker processes costs more than it saves
+PARALLEL_MIN_FILES: Final = 8
+
+# Included files often repeat the same lines, so remember what Requirement.parse
+# made of them. Failures are kept as their error message, so a repeated bad line
+# reuses the same string.
+_REQ_CACHE: Final[dict[str, Requirement | str]] = {}
+_REQ_CACHE_MAX: Final = 2048
+
+
+def _parse_requirement(line: str) -> Requirement | str:
+    req = _REQ_CACHE.get(line)
+    if req is None:
+        try:
+            req = Requirement.parse(line)
+        except Exception as ex:
+            req = f"Could not parse line: {ex}"
+
+        if len(_REQ_CACHE) >= _REQ_CACHE_MAX:
+            del _REQ_CACHE[next(iter(_REQ_CACHE))]
+        _REQ_CACHE[line] = req
+
+    return req
+
+
+class LineType(IntEnum):
+    requirement = 0
+    error = 1
+    unsupported = 2
+    other = 3
+
+
+class UpdateStatus(IntEnum):
+    ok = 0
+    behind = 1
+    unpinned = 2
+    unknown = 3
+
+
+@dataclass(slots=True)
 class Line:
     ltype: LineType
 
@@ -31,6 +86,7 @@ class Line:
     line: str | None = None
     error: str | None = None
     spec: str | None = None
+    spec_ver: Version | None = None
 
     latest: str | None = None
     url: str | None = None
@@ -42,95 +98,202 @@ class Line:
         return f"{self.filename}:{self.lineno}"
 
 
+def _is_file(path: str) -> bool:
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
 class ReqFile:
     def __init__(self, filepath: str) -> None:
         self.filepath: str = filepath
-        self.filename: str = os.path.basename(filepath)
-        self.lines: list[Line] = []
+        # Shared by every Line; files included from several directories often share a name
+        self.filename: str = sys.intern(os.path.basename(filepath))
         self.other_files: list[str] = []
-        self._lineno = 1
+        self._dirname = os.path.dirname(filepath) or "."
+        self._lines: list[Line] | None = None
+
+        # Read and decode the whole file in one go, then split it with universal newlines
+        # as text mode would, so rewritten files keep the platform's line endings.
+        with open(self.filepath, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size < MMAP_MIN_SIZE:
+                text = fh.read().decode(ENCODING, ENCODING_ERRORS)
+            else:
+                # Decode straight from the mapping instead of copying the file into bytes first
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    text = str(mm, ENCODING, ENCODING_ERRORS)
+        self._raw_lines = io.StringIO(text, newline=None).readlines()
 
-        with open(self.filepath, "r") as fh:
-            lines = fh.readlines()
+        # Following includes only needs the '-r' lines; everything else is parsed
+        # the first time `lines` is used. Most files include nothing ('--requirement'
+        # contains '-r' too), so check the whole text once before looking at lines.
+        if "-r" not in text:
+            return
+
+        for line in self._raw_lines:
+            if line.lstrip().startswith(_REQ_INCLUDE):
+                new_file = self._include_path(line)
+                if new_file is not None and _is_file(new_file):
+                    self.other_files.append(new_file)
+
+    @property
+    def lines(self) -> list[Line]:
+        if self._lines is None:
+            self.parse()
+        return cast(list[Line], self._lines)
 
-        for line in lines:
-            self._parse_line(line)
-            self._lineno += 1
+    def parse(self) -> None:
+        # Every raw line becomes exactly one Line, so size the list up front
+        lines: list[Line | None] = [None] * len(self._raw_lines)
+        for lineno, line in enumerate(self._raw_lines, start=1):
+            lines[lineno - 1] = self._parse_line(line, lineno)
+        self._raw_lines = []
+        self._lines = cast(list[Line], lines)
 
     def store(
         self,
         line: str,
+        lineno: int,
         status: LineType,
         pkgname: str | None = None,
         error: str | None = None,
         spec: str | None = None,
-    ) -> None:
-        self.lines.append(Line(status, self.filename, self._lineno, pkgname, line, error, spec))
+        spec_ver: Version | None = None,
+    ) -> Line:
+        return Line(status, self.filename, lineno, pkgname, line, error, spec, spec_ver)
 
-    def _parse_line(self, line: str) -> None:
-        if line.strip() == "":
-            return self.store(line, LineType.other)
+    def _parse_line(self, line: str, lineno: int) -> Line:
+        stripped = line.lstrip()
+        if not stripped or stripped[0] == "#":
+            return self.store(line, lineno, LineType.other)
 
-        elif not line or line.startswith("#"):
-            return self.store(line, LineType.other)
+        # Lines starting with '-' or './' are classified by their prefix; everything
+        # else is a requirement.
+        handler = _PREFIX_HANDLERS.get(stripped[:2]) or _PREFIX_HANDLERS.get(stripped[:1])
+        if handler is not None:
+            return handler(self, line, lineno)
 
-        # Other requirements files.
-        elif line.startswith("-r") or line.startswith("--requirement"):
-            _, new_filename = line.split()
-            new_file = os.path.join(os.path.dirname(self.filepath or "."), new_filename)
-            if not os.path.exists(new_file):
-                return self.store(
-                    line,
-                    LineType.error,
-                    error="Requirement file does not exist",
-                    pkgname=new_file,
-                )
-            else:
-                self.other_files.append(new_file)
-                return self.store(line, LineType.other)
+        return self._parse_requirement(line, lineno)
 
-        elif line.startswith("-"):
-            return self.store(line, LineType.unsupported, error="Unsupported argument")
+    def _include_path(self, line: str) -> str | None:
+        stripped = line.strip()
+        if stripped.startswith("--requirement="):
+            new_filename = stripped[len("--requirement="):].strip()
+        else:
+            parts = stripped.split(maxsplit=1)
+            new_filename = parts[1] if len(parts) == 2 else ""
+
+        if not new_filename:
+            return None
+        return os.path.join(self._dirname, new_filename)
+
+    def _parse_include(self, line: str, lineno: int) -> Line:
+        new_file = self._include_path(line)
+        if new_file is None:
+            return self.store(
+                line,
+                lineno,
+                LineType.error,
+                error="No requirement file given",
+            )
+
+        if new_file not in self.other_files:
+            return self.store(
+                line,
+                lineno,
+                LineType.error,
+                error="Requirement file does not exist",
+                pkgname=new_file,
+            )
+
+        return self.store(line, lineno, LineType.other)
+
+    def _parse_option(self, line: str, lineno: int) -> Line:
+        if line.lstrip().startswith(_REQ_INCLUDE):
+            return self._parse_include(line, lineno)
+        return self.store(line, lineno, LineType.unsupported, error="Unsupported argument")
 
-        elif line.startswith("./"):
-            return self.store(line, LineType.unsupported, error="Local files unsupported")
+    def _parse_local(self, line: str, lineno: int) -> Line:
+        return self.store(line, lineno, LineType.unsupported, error="Local files unsupported")
 
+    def _parse_requirement(self, line: str, lineno: int) -> Line:
+        pkgname: str | None
+        spec: str | None
+
+        # Most lines are a bare name or a single pin, which don't need the full parser.
+        match = _SIMPLE_REQ_RE.match(line)
+        if match:
+            pkgname, spec = match.group("name"), match.group("spec")
         else:
-            try:
-                req = Requirement.parse(line)
-            except Exception as ex:
+            req = _parse_requirement(line)
+            if isinstance(req, str):
                 return self.store(
                     line,
+                    lineno,
                     LineType.error,
-                    error=f"Could not parse line: {ex}",
+                    error=req,
                 )
 
+            pkgname, specs = req.name, req.specs
             if req.uri:
                 return self.store(
                     line,
+                    lineno,
                     LineType.unsupported,
-                    pkgname=req.name,
+                    pkgname=pkgname,
                     error="Package URLs unsupported",
                 )
 
-            if len(req.specs) == 0:
-                # Unpinned requirement.
-                return self.store(line, LineType.requirement, pkgname=req.name)
-
-            if len(req.specs) != 1:
+            if not specs:
+                spec = None
+            elif len(specs) == 1 and specs[0][0] in _SUPPORTED_OPS:
+                spec = specs[0][1]
+            else:
                 return self.store(
                     line,
+                    lineno,
                     LineType.unsupported,
                     error="Unsupported version spec",
-                    pkgname=req.name,
+                    pkgname=pkgname,
                 )
 
-            if req.specs[0][0] not in ["==", ">="]:
-                return self.store(
-                    line,
-                    LineType.unsupported,
-                    error="Unsupported version spec",
-                    pkgname=req.name,
-                )
+        if spec is None:
+            # Unpinned requirement.
+            return self.store(line, lineno, LineType.requirement, pkgname=pkgname)
+
+        try:
+            spec_ver = Version(spec)
+        except InvalidVersion:
+            # e.g. a wildcard pin such as ==1.*
+            return self.store(
+                line,
+                lineno,
+                LineType.unsupported,
+                error="Unsupported version spec",
+                pkgname=pkgname,
+            )
+
+        return self.store(line, lineno, LineType.requirement, pkgname=pkgname, spec=spec, spec_ver=spec_ver)
+
+
+_PREFIX_HANDLERS: Final[dict[str, Callable[[ReqFile, str, int], Line]]] = {
+    "-": ReqFile._parse_option,
+    "./": ReqFile._parse_local,
+}
+
+
+def _parse_eagerly(path: str) -> ReqFile:
+    # Runs in a worker process, so parse the lines there rather than lazily
+    # back in the parent
+    rf = ReqFile(path)
+    rf.parse()
+    return rf
+
+
+def parse_files(paths: list[str]) -> list[ReqFile]:
+    if len(paths) < PARALLEL_MIN_FILES:
+        return [ReqFile(path) for path in paths]
 
-            self.store(line, LineType.requirement, pkgname=req.name, spec=req.specs[0][1])
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(_parse_eagerly, paths, chunksize=8))